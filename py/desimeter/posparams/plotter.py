@@ -6,6 +6,7 @@ Plot time series of positioner parameters.
 import os
 import matplotlib.pyplot as plt
 import matplotlib.colors
+import matplotlib.figure
 import numpy as np
 from astropy.time import Time
 
@@ -15,8 +16,16 @@ error_series_filename = 'fiterror' + img_ext
 tick_period_days = 7
 day_in_sec = 24*60*60
 DATE_SEC = 'DATA_END_DATE_SEC'
+max_plot_points = 2000  # longer series are decimated by _decimate()
+decimate_bins = 1000
+param_plot_dpi = 100  # resolution of the per-positioner parameter plots
+png_compress_level = 3
 
-def plot_params(table, savepath, statics_during_dynamic):
+# figure reused by plot_param_data, see _param_figure()
+_param_fig = None
+_param_axes = None
+
+def plot_params(table, savepath, statics_during_dynamic, dpi=param_plot_dpi):
     '''Plot time series of positioner parameters for a single positioner.
 
     Inputs:
@@ -29,66 +38,115 @@ def plot_params(table, savepath, statics_during_dynamic):
         statics_during_dynamic ... Dict of static params used during the
                      dynamic params best-fit
 
+        dpi      ... Resolution of the saved image.
+
     Outputs:
         The plot image file is saved to savepath. A log string is returned
         suitable for print to stdout, stating what was done.
     '''
-    fig = _init_plot()
-    table.sort(DATE_SEC)
-    posid = table['POS_ID'][0]
-    fig.subplots_adjust(wspace=.3, hspace=.3)
-    times = table[DATE_SEC]
+    return plot_param_data(param_data(table), savepath, statics_during_dynamic, dpi=dpi)
+
+def param_data(table):
+    '''Extract from a table the data plotted by plot_param_data().
+
+    Inputs:
+        table    ... Astropy table as generated by fit_params, then reduced to
+                     just the rows for a single POS_ID.
+
+    Outputs:
+        dict with keys 'posid', 'analysis_date', 'times' (array of dates in
+        seconds since epoch) and 'values' (dict of arrays, one per plotted
+        column, scaled by the subplot's 'mult'). All arrays are sorted by date.
+        Being only numpy arrays and strings, this is much lighter than the
+        table to send to a worker process.
+    '''
+    order = np.argsort(table[DATE_SEC], kind='stable')
+    values = {}
+    for p in param_subplot_defs:
+        for key in p['keys']:
+            y = np.asarray(table[key], dtype=float)[order]
+            if p['mult'] != 1:
+                y = y * p['mult']
+            values[key] = y
+    data = {'posid': str(table['POS_ID'][0]),
+            'analysis_date': str(table['ANALYSIS_DATE_DYNAMIC'][order[-1]]),
+            'times': np.asarray(table[DATE_SEC], dtype=float)[order],
+            'values': values}
+    return data
+
+def plot_param_data(data, savepath, statics_during_dynamic, dpi=param_plot_dpi):
+    '''Same as plot_params(), but taking as input the dict returned by
+    param_data() instead of the table.
+    '''
+    fig, axes = _param_figure()
+    posid = data['posid']
+    times = data['times']
     tick_values, tick_labels = _ticks(times)
-    n_pts = len(table)
+    n_pts = len(times)
     marker = ''
     for p in param_subplot_defs:
-        plt.subplot(2, 3, p['subplot'])
+        ax_left = axes[p['subplot'] - 1]
+        ax_right = ax_left.twinx() if len(p['keys']) > 1 else None
         for key in p['keys']:
-            ax_right = None
             if p['keys'].index(key) == 1:
-                ax_right = plt.twinx()
+                ax = ax_right
                 color = 'red'
                 linestyle = '--'
                 if n_pts == 1:
                     marker = '^'
             else:
+                ax = ax_left
                 color = 'blue'
                 linestyle = '-'
                 if n_pts == 1:
                     marker = 'v'
-            y = [val * p['mult'] for val in table[key]]#.tolist()]
-            plt.plot(times, y, color=color, linestyle=linestyle, marker=marker)
-            if not ax_right:
-                ax_left = plt.gca()
+            y = data['values'][key]
+            if n_pts > max_plot_points:
+                x_bin, y_min, y_max = _decimate(times, y)
+                ax.fill_between(x_bin, y_min, y_max, color=color, linestyle=linestyle, alpha=0.5)
+            else:
+                ax.plot(times, y, color=color, linestyle=linestyle, marker=marker)
             units = f' ({p["units"]})' if p['units'] else ''
-            plt.ylabel(key + units, color=color)
+            ax.set_ylabel(key + units, color=color)
             if p['logscale']:
-                plt.yscale('log')
+                ax.set_yscale('log')
             if 'ylims' in p:
-                plt.ylim(p['ylims'])
-            if ax_right and p['equal_scales']:
-                min_y = min(ax_left.get_ylim()[0], ax_right.get_ylim()[0])
-                max_y = max(ax_left.get_ylim()[1], ax_right.get_ylim()[1])
-                ax_left.set_ylim((min_y, max_y))
-                ax_right.set_ylim((min_y, max_y))
-            plt.xticks(tick_values, tick_labels, rotation=90, horizontalalignment='center', fontsize=8)
-            plt.yticks(fontsize=8)
-            if 'SCALE_P_DYNAMIC' in key:
-                s = statics_during_dynamic
-                plt.text(min(plt.xlim()), min(plt.ylim()),
-                         f' Using static params:\n'
-                         f' LENGTH_R1 = {s["LENGTH_R1"]:>7.3f}, LENGTH_R2 = {s["LENGTH_R2"]:>7.3f}\n'
-                         f' OFFSET_X = {s["OFFSET_X"]:>8.3f}, OFFSET_Y = {s["OFFSET_Y"]:>8.3f}\n'
-                         f' OFFSET_T = {s["OFFSET_T"]:>8.3f}, OFFSET_P = {s["OFFSET_P"]:>8.3f}\n',
-                         verticalalignment='bottom', fontfamily='monospace')
-    analysis_date = table['ANALYSIS_DATE_DYNAMIC'][-1]
+                ax.set_ylim(p['ylims'])
+
+        # common axis setup, once per subplot after all its keys are drawn
+        if ax_right and p['equal_scales']:
+            min_y = min(ax_left.get_ylim()[0], ax_right.get_ylim()[0])
+            max_y = max(ax_left.get_ylim()[1], ax_right.get_ylim()[1])
+            ax_left.set_ylim((min_y, max_y))
+            ax_right.set_ylim((min_y, max_y))
+        ax_left.set_xticks(tick_values)
+        ax_left.set_xticklabels(tick_labels, rotation=90, horizontalalignment='center', fontsize=8)
+        for ax in (ax_left, ax_right):
+            if ax:
+                ax.tick_params(axis='y', labelsize=8)
+        if 'SCALE_P_DYNAMIC' in p['keys']:
+            ax = ax_right
+            s = statics_during_dynamic
+            ax.text(min(ax.get_xlim()), min(ax.get_ylim()),
+                    f' Using static params:\n'
+                    f' LENGTH_R1 = {s["LENGTH_R1"]:>7.3f}, LENGTH_R2 = {s["LENGTH_R2"]:>7.3f}\n'
+                    f' OFFSET_X = {s["OFFSET_X"]:>8.3f}, OFFSET_Y = {s["OFFSET_Y"]:>8.3f}\n'
+                    f' OFFSET_T = {s["OFFSET_T"]:>8.3f}, OFFSET_P = {s["OFFSET_P"]:>8.3f}\n',
+                    verticalalignment='bottom', fontfamily='monospace')
+    analysis_date = data['analysis_date']
     title = f'{posid}'
     title += f'\nbest-fits to historical data'
     title += f'\nanalysis date: {analysis_date}'
-    plt.suptitle(title)
-    _save_and_close_plot(fig, savepath)
+    fig.suptitle(title)
+    fig.savefig(savepath, bbox_inches='tight', dpi=dpi, **_savefig_kwargs(savepath))
     return f'{posid}: plot saved to {savepath}'
 
+def plot_param_data_star(args):
+    '''Same as plot_param_data(), with its arguments packed into a single tuple.
+    For use with multiprocessing.Pool.imap_unordered().
+    '''
+    return plot_param_data(*args)
+
 def plot_passfail(binned, savepath, title='', printf=print):
     '''Plot time series of positioenr pass/fail groups, binned by error ceilings.
 
@@ -172,8 +230,11 @@ def bin_errors(table, bins=5, mode='static', printf=print):
                 e.g. binned['passing_counts'][ceiling] --> list of values
     '''
     err_key = 'FIT_ERROR_' + mode.upper()
-    min_err = min(table[err_key])
-    max_err = max(table[err_key])
+    errs = np.asarray(table[err_key].data)
+    dates = np.asarray(table[DATE_SEC].data)
+    all_posids = np.asarray(table['POS_ID'].data)
+    min_err = errs.min()
+    max_err = errs.max()
     try:
         n_bins = int(bins)
         edges = np.linspace(min_err, max_err, n_bins + 1)
@@ -182,29 +243,29 @@ def bin_errors(table, bins=5, mode='static', printf=print):
         edges = np.array(bins)
     bin_ceilings = edges[1:]
     period_duration = day_in_sec
-    periods = sorted(set(table[DATE_SEC]))
-    posids = set(table['POS_ID'])
-    subtables = {}
+    periods = np.unique(dates).tolist()
+    posids = set(all_posids)
+    subsets = {}
     for i,period in enumerate(periods):
         start = period - period_duration
         if i == 0:
-            after = start <= table[DATE_SEC]
+            after = start <= dates
         else:
-            after = start < table[DATE_SEC]
-        until = period >= table[DATE_SEC]
+            after = start < dates
+        until = period >= dates
         selected = until & after
-        subtables[period] = table[selected]
+        subsets[period] = (all_posids[selected], errs[selected])
     passing = {}
     failing = {}
     for ceiling in bin_ceilings:
         passing[ceiling] = {}
         failing[ceiling] = {}
         for i,period in enumerate(periods):
-            subtable = subtables[period]
-            pass_selection = subtable[err_key] <= ceiling
+            period_posids, period_errs = subsets[period]
+            pass_selection = period_errs <= ceiling
             fail_selection = ~pass_selection
-            pass_set = set(subtable[pass_selection]['POS_ID'])
-            fail_set = set(subtable[fail_selection]['POS_ID'])
+            pass_set = set(period_posids[pass_selection])
+            fail_set = set(period_posids[fail_selection])
             pass_set -= fail_set  # if two conflicting entries for same posid in that data window
             if i > 0:
                 known = pass_set | fail_set
@@ -253,6 +314,23 @@ def bin_errors(table, bins=5, mode='static', printf=print):
         binned[key] = {ceiling: values.tolist() for ceiling, values in binned[key].items()}
     return binned
 
+def _param_figure():
+    '''Internal function returning the figure and flat list of axes used for
+    parameter plots. The figure is created once per process, then reused with
+    its axes cleared, rather than building a new figure for every positioner.'''
+    global _param_fig, _param_axes
+    if _param_fig is None:
+        _param_fig = matplotlib.figure.Figure(figsize=(20,10), dpi=param_plot_dpi)
+        _param_axes = list(_param_fig.subplots(2, 3).flat)
+        _param_fig.subplots_adjust(wspace=.3, hspace=.3)
+    else:
+        for ax in _param_fig.axes:
+            if ax not in _param_axes:
+                ax.remove()  # twin axes of the previous plot
+        for ax in _param_axes:
+            ax.cla()
+    return _param_fig, _param_axes
+
 def _init_plot(figsize=(20,10)):
     '''Internal common plot initialization function. Returns figure handle.'''
     plt.ioff()
@@ -264,16 +342,39 @@ def _save_and_close_plot(fig, savepath):
     '''Internal common plot saving and closing function. Argue the figure
     handle to close, and the path where to save the image. Extension determines
     image format.'''
-    plt.savefig(savepath, bbox_inches='tight')
+    plt.savefig(savepath, bbox_inches='tight', **_savefig_kwargs(savepath))
     plt.close(fig)
 
+def _savefig_kwargs(savepath):
+    '''Internal function returning extra savefig() arguments for the image
+    format of savepath. PNG files are written with a fast zlib level rather
+    than the default maximum compression.'''
+    if os.path.splitext(savepath)[-1].lower() == '.png':
+        return {'pil_kwargs': {'compress_level': png_compress_level}}
+    return {}
+
 def _ticks(times):
     '''Internal common function to generate tick values and labels, given a
     vector of dates in seconds since epoch.'''
     tick_values = np.arange(times[0], times[-1]+day_in_sec, tick_period_days*day_in_sec)
-    tick_labels = [Time(t, format='unix', out_subfmt='date').iso for t in tick_values]
+    # keep the date part of the iso strings (out_subfmt='date' is rejected
+    # for format='unix' by recent astropy)
+    tick_labels = [iso.split(' ')[0] for iso in Time(tick_values, format='unix').iso]
     return tick_values, tick_labels
 
+def _decimate(x, y, n_bins=decimate_bins):
+    '''Internal function to reduce a dense series, with x sorted in increasing
+    order, to the min and max of y within n_bins equal-width bins of x. Returns
+    mean x, min y and max y of the non-empty bins.'''
+    edges = np.linspace(x[0], x[-1], n_bins + 1)
+    starts = np.unique(np.searchsorted(x, edges[:-1], side='left'))
+    starts = starts[starts < len(x)]
+    counts = np.diff(np.append(starts, len(x)))
+    x_bin = np.add.reduceat(x, starts) / counts
+    y_min = np.fmin.reduceat(y, starts)
+    y_max = np.fmax.reduceat(y, starts)
+    return x_bin, y_min, y_max
+
 def _colors(v):
     '''Generate colors for vector v of scalar values.'''
     V = np.abs(v)
@@ -0,0 +1,63 @@
+import unittest
+import os
+import tempfile
+
+import numpy as np
+from astropy.table import Table
+from desimeter.posparams import plotter
+from desimeter.posparams.fitter import static_keys
+
+class TestPlotter(unittest.TestCase):
+
+    def test_decimate(self):
+        rng = np.random.RandomState(0)
+        x = np.sort(rng.uniform(0, 100, 5000))
+        y = rng.normal(size=5000)
+        x_bin, y_min, y_max = plotter._decimate(x, y, n_bins=10)
+        edges = np.linspace(x[0], x[-1], 11)
+        self.assertEqual(len(x_bin), 10)
+        for i in range(10):
+            if i < 9:
+                ii = (x >= edges[i]) & (x < edges[i+1])
+            else:
+                ii = (x >= edges[i])
+            self.assertAlmostEqual(x_bin[i], x[ii].mean())
+            self.assertEqual(y_min[i], y[ii].min())
+            self.assertEqual(y_max[i], y[ii].max())
+        self.assertEqual(y_min.min(), y.min())
+        self.assertEqual(y_max.max(), y.max())
+
+    def test_decimate_constant_x(self):
+        x = np.full(10, 3.)
+        y = np.arange(10.)
+        x_bin, y_min, y_max = plotter._decimate(x, y)
+        self.assertTrue(np.all(x_bin == [3.]))
+        self.assertTrue(np.all(y_min == [0.]))
+        self.assertTrue(np.all(y_max == [9.]))
+
+    def test_decimate_nan(self):
+        x = np.arange(10.)
+        y = np.arange(10.)
+        y[[0, 7]] = np.nan
+        x_bin, y_min, y_max = plotter._decimate(x, y, n_bins=2)
+        self.assertTrue(np.all(y_min == [1., 5.]))
+        self.assertTrue(np.all(y_max == [4., 9.]))
+
+    def test_plot_params_dense(self):
+        rng = np.random.RandomState(1)
+        n = plotter.max_plot_points + 1
+        table = Table()
+        table['POS_ID'] = ['M00000'] * n
+        table[plotter.DATE_SEC] = 1.58e9 + np.arange(n) * 600.
+        table['ANALYSIS_DATE_DYNAMIC'] = ['2020-04-01 00:00:00'] * n
+        for p in plotter.param_subplot_defs:
+            for key in p['keys']:
+                table[key] = rng.uniform(0.01, 1, n)
+        statics = {key: 1. for key in static_keys}
+        with tempfile.TemporaryDirectory() as tmpdir:
+            savepath = os.path.join(tmpdir, 'M00000_paramfits' + plotter.img_ext)
+            plotter.plot_params(table, savepath, statics)
+            self.assertTrue(os.path.getsize(savepath) > 0)
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,138 @@
+import unittest
+import importlib.util
+
+import numpy as np
+from astropy.table import Table
+import desimeter.transform.ptl2fp as ptl2fp_module
+from desimeter.transform.ptl2fp import apply_ptl2fp, ptl2fp, fp2ptl, Rx, Ry, Rz, Rxyz, Rxyz_batch
+
+class TestPtl2FP(unittest.TestCase):
+
+    def setUp(self):
+        rng = np.random.RandomState(12)
+        nspot = 200
+        self.spots = Table()
+        self.spots['PETAL_LOC'] = rng.randint(0, 10, size=nspot)
+        self.spots['X_PTL'] = rng.uniform(-400, 400, size=nspot)
+        self.spots['Y_PTL'] = rng.uniform(-400, 400, size=nspot)
+        self.spots['Z_PTL'] = rng.uniform(-10, 0, size=nspot)
+
+    def test_rxyz(self):
+        rng = np.random.RandomState(1)
+        for alpha, beta, gamma in rng.uniform(-np.pi, np.pi, size=(20, 3)):
+            ref = Rz(gamma) @ Ry(beta) @ Rx(alpha)
+            self.assertTrue(np.allclose(Rxyz(alpha, beta, gamma), ref))
+
+    def test_rxyz_batch(self):
+        rng = np.random.RandomState(2)
+        alphas, betas, gammas = rng.uniform(-np.pi, np.pi, size=(3, 20))
+        R = Rxyz_batch(alphas, betas, gammas)
+        self.assertEqual(R.shape, (20, 3, 3))
+        for i in range(20):
+            self.assertTrue(np.allclose(R[i], Rxyz(alphas[i], betas[i], gammas[i])))
+
+    def test_petal_index(self):
+        petal_loc = np.array([7, 3, 3, 9, 0, 7])
+        for values in (petal_loc, petal_loc.astype(float)):
+            for max_petal_loc in (9, 5):
+                petals, index = ptl2fp_module._petal_index(values, max_petal_loc)
+                self.assertTrue(np.all(petals == [0, 3, 7, 9]))
+                self.assertTrue(np.all(petals[index] == petal_loc))
+
+    def test_unknown_petal(self):
+        spots = self.spots.copy()
+        spots['PETAL_LOC'][0] = 99999999
+        with self.assertRaises(KeyError):
+            apply_ptl2fp(spots)
+
+    def test_apply_ptl2fp(self):
+        spots = apply_ptl2fp(self.spots.copy())
+        for petal in np.unique(spots['PETAL_LOC']):
+            ii = (spots['PETAL_LOC'] == petal)
+            x, y, z = ptl2fp(petal, spots['X_PTL'][ii], spots['Y_PTL'][ii], spots['Z_PTL'][ii])
+            self.assertTrue(np.allclose(spots['X_FP'][ii], x))
+            self.assertTrue(np.allclose(spots['Y_FP'][ii], y))
+            self.assertTrue(np.allclose(spots['Z_FP'][ii], z))
+
+    def test_apply_ptl2fp_nan(self):
+        spots = self.spots.copy()
+        spots['X_PTL'][0] = np.nan
+        spots['Y_PTL'][1] = np.inf
+        spots = apply_ptl2fp(spots)
+        for k in ['X_FP', 'Y_FP', 'Z_FP']:
+            self.assertFalse(np.isfinite(spots[k][0]))
+            self.assertFalse(np.isfinite(spots[k][1]))
+            self.assertTrue(np.all(np.isfinite(spots[k][2:])))
+
+    @unittest.skipIf(importlib.util.find_spec('numba') is None, 'numba not installed')
+    def test_numba_kernel(self):
+        rng = np.random.RandomState(3)
+        npetal, nspot = 10, 1000
+        Rotations = Rxyz_batch(*rng.uniform(-0.1, 0.1, size=(3, npetal)))
+        Translations = rng.uniform(-1, 1, size=(npetal, 3))
+        petal_index = rng.randint(0, npetal, size=nspot)
+        xyzptl = rng.uniform(-400, 400, size=(nspot, 3))
+        ref = ptl2fp_module._apply_rotations_numpy(xyzptl, petal_index, Rotations, Translations)
+        xyzfp = ptl2fp_module._apply_rotations(xyzptl, petal_index, Rotations, Translations, min_size=0)
+        self.assertTrue(np.allclose(xyzfp, ref))
+        xyzptl[0, 0] = np.nan
+        xyzfp = ptl2fp_module._apply_rotations(xyzptl, petal_index, Rotations, Translations, min_size=0)
+        self.assertTrue(np.all(np.isnan(xyzfp[0])))
+
+    def test_apply_ptl2fp_float32(self):
+        ref = apply_ptl2fp(self.spots.copy())
+        spots = apply_ptl2fp(self.spots.copy(), dtype=np.float32)
+        for k in ['X_FP', 'Y_FP', 'Z_FP']:
+            self.assertEqual(spots[k].dtype, np.float32)
+            self.assertTrue(np.allclose(spots[k], ref[k], rtol=0, atol=1e-3))
+        # precision must not stick to a reused table
+        spots = apply_ptl2fp(spots)
+        for k in ['X_FP', 'Y_FP', 'Z_FP']:
+            self.assertEqual(spots[k].dtype, np.float64)
+            self.assertTrue(np.all(spots[k] == ref[k]))
+        spots = apply_ptl2fp(spots, dtype=np.float32)
+        for k in ['X_FP', 'Y_FP', 'Z_FP']:
+            self.assertEqual(spots[k].dtype, np.float32)
+
+    def test_apply_ptl2fp_twice(self):
+        spots = apply_ptl2fp(self.spots.copy())
+        spots['X_PTL'] += 1.
+        spots = apply_ptl2fp(spots)
+        ref = self.spots.copy()
+        ref['X_PTL'] += 1.
+        ref = apply_ptl2fp(ref)
+        for k in ['X_FP', 'Y_FP', 'Z_FP']:
+            self.assertTrue(np.allclose(spots[k], ref[k]))
+
+    def test_apply_ptl2fp_slice(self):
+        spots = apply_ptl2fp(self.spots.copy())
+        x_fp = spots['X_FP'].copy()
+        old = spots['X_FP']
+        view = spots[0:5]
+        view['X_PTL'] += 1.
+        apply_ptl2fp(view)
+        self.assertTrue(np.all(spots['X_FP'] == x_fp))
+        self.assertTrue(np.all(old == x_fp))
+        self.assertFalse(np.allclose(view['X_FP'], x_fp[0:5]))
+
+    def test_alignment_arrays(self):
+        rows, Rotations, Translations = ptl2fp_module.get_petal_alignment_arrays()
+        alignment = ptl2fp_module.get_petal_alignment_data()
+        for petal, params in alignment.items():
+            i = rows[petal]
+            R = Rxyz(params["alpha"], params["beta"], params["gamma"])
+            self.assertTrue(np.allclose(Rotations[i], R))
+            self.assertTrue(np.allclose(Translations[i], [params["Tx"], params["Ty"], params["Tz"]]))
+        self.assertIs(ptl2fp_module.get_petal_alignment_arrays()[1], Rotations)
+
+    def test_roundtrip(self):
+        spots = apply_ptl2fp(self.spots.copy())
+        for petal in np.unique(spots['PETAL_LOC']):
+            ii = (spots['PETAL_LOC'] == petal)
+            x, y, z = fp2ptl(petal, spots['X_FP'][ii], spots['Y_FP'][ii], spots['Z_FP'][ii])
+            self.assertTrue(np.allclose(spots['X_PTL'][ii], x))
+            self.assertTrue(np.allclose(spots['Y_PTL'][ii], y))
+            self.assertTrue(np.allclose(spots['Z_PTL'][ii], z))
+
+if __name__ == '__main__':
+    unittest.main()